@@ -1,15 +1,23 @@
+"""HTTP client and parsers for the Climatix HMI web pages.
+
+Parsing here is interpreter-bound string work, so keep it inside the C
+regex engine: every pattern is ``re.compile``d at module load (no inline
+``re.search``/``re.sub`` with literal patterns in the parsers) and HTML
+is matched with these regexes rather than a DOM library.
+"""
 import os
 import re
+import sys
+import threading
 import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Tuple, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-
-try:
-    from bs4 import BeautifulSoup
-except Exception:
-    BeautifulSoup = None
+from urllib3.util.retry import Retry
 
 
 def _get_env(name: str, default: Optional[str] = None) -> Optional[str]:
@@ -22,8 +30,19 @@ class HMIClient:
         if not base_url.endswith("/"):
             base_url += "/"
         self.base = base_url
+        self.input_url = base_url + 'HMIinput.cgi'
         self.sess = requests.Session()
         self.sess.auth = HTTPBasicAuth(username, password)
+        # requests already sends gzip/deflate Accept-Encoding and keep-alive by default
+        self.sess.headers["User-Agent"] = "benekov-mqtt"
+        # Keep a small pool to the HMI and ride out short 502/503/504 hiccups without reconnecting.
+        # Mounted on the base URL, so HMIinput.cgi writes are retried too; they set absolute
+        # values, so sending one twice is harmless.
+        retry = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504))
+        self.sess.mount(self.base, HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+
+    def close(self):
+        self.sess.close()
 
     def fetch(self, path: str) -> str:
         url = self.base + path
@@ -32,6 +51,14 @@ class HMIClient:
         r.encoding = 'utf-8'
         return r.text
 
+    def fetch_stream(self, path: str, chunk_size: int = 8192):
+        """Yield the raw body in byte chunks instead of buffering it whole."""
+        url = self.base + path
+        with self.sess.get(url, stream=True, timeout=10) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                yield chunk
+
     def fetch_bytes(self, path: str) -> bytes:
         url = self.base + path
         r = self.sess.get(url, timeout=10)
@@ -41,6 +68,8 @@ class HMIClient:
 
 LANG_RE = re.compile(r"var\s+languages(\d)\s*=\s*\{(.*?)\};", re.S)
 KEY_RE = re.compile(r"\"([^\"]+)\"\s*:\s*\[(.*?)\]\s*,?\s*$", re.M)
+_STR_RE = re.compile(r"\"((?:[^\"\\]|\\.)*)\"", re.S)
+_ESC_RE = re.compile(r"\\(.)", re.S)
 
 
 def parse_languages(js_text: str) -> Dict[str, List[str]]:
@@ -50,38 +79,53 @@ def parse_languages(js_text: str) -> Dict[str, List[str]]:
         for km in KEY_RE.finditer(block):
             key = km.group(1)
             arr_raw = km.group(2)
-            items = []
-            cur = ''
-            in_q = False
-            esc = False
-            for ch in arr_raw:
-                if not in_q:
-                    if ch == '"':
-                        in_q = True
-                        cur = ''
-                else:
-                    if esc:
-                        cur += ch
-                        esc = False
-                    elif ch == '\\':
-                        esc = True
-                    elif ch == '"':
-                        items.append(cur)
-                        in_q = False
-                    else:
-                        cur += ch
+            items = [_ESC_RE.sub(r"\1", q) for q in _STR_RE.findall(arr_raw)]
             langs[key] = items
     return langs
 
 
+def _safe_fetch(client: HMIClient, path: str) -> str:
+    try:
+        return client.fetch(path)
+    except Exception:
+        return ""
+
+
 def build_languages(client: HMIClient) -> Dict[str, List[str]]:
-    js_all = ""
-    for name in ("HMILang1.js", "HMILang2.js", "HMILang3.js", "HMILang4.js"):
-        try:
-            js_all += client.fetch(name) + "\n\n"
-        except Exception:
-            continue
-    return parse_languages(js_all)
+    names = ("HMILang1.js", "HMILang2.js", "HMILang3.js", "HMILang4.js")
+    # Fetch all language files concurrently over the shared session
+    with ThreadPoolExecutor(max_workers=len(names)) as ex:
+        parts = list(ex.map(lambda n: _safe_fetch(client, n), names))
+    return parse_languages("\n\n".join(p for p in parts if p))
+
+
+class LazyLanguages(Mapping):
+    """Language table that downloads and parses HMILangN.js on first lookup."""
+
+    def __init__(self, client: HMIClient):
+        self._client = client
+        self._data: Optional[Dict[str, List[str]]] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, List[str]]:
+        if self._data is None:
+            # Pages are parsed from several threads; only the first one downloads
+            with self._lock:
+                if self._data is None:
+                    self._data = build_languages(self._client)
+        return self._data
+
+    def __getitem__(self, key: str) -> List[str]:
+        return self._load()[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self) -> int:
+        return len(self._load())
 
 
 def resolve_text_from_lg(languages: Dict[str, List[str]], key: Optional[str], lang_index: int = 0, fallback: str = "") -> str:
@@ -93,118 +137,150 @@ def resolve_text_from_lg(languages: Dict[str, List[str]], key: Optional[str], la
 
 
 DIV_RE = re.compile(r"<div\s+id=['\"]d(\d+)['\"]>(.*?)</div>", re.S)
-TD_LABEL_RE = re.compile(r"<td[^>]*id=['\"]l(\d+)['\"][^>]*>(.*?)</td>", re.S)
 A_LINK_RE = re.compile(r"<a[^>]*id=['\"]a(\d+)['\"][^>]*href=\"([^\"]+)\"", re.S)
-SPAN_VAL_RE = re.compile(r"<span[^>]*id=\"(o\d+)\"([^>]*)>(.*?)</span>", re.S)
-SPAN_GLOBAL_RE = SPAN_VAL_RE
+
+# One walk over a div block: label cell, first value span (it="v"/"e") or unit span.
+# Only opening tags are matched, so nested markup can't hide a later hit; the inner text
+# is sliced up to the closing tag afterwards.
+_BLOCK_RE = re.compile(
+    r"<td[^>]*id=['\"]l\d+['\"][^>]*>(?P<label>)"
+    r"|<span[^>]*id=\"(?P<vid>o\d+)\"(?P<vattr>[^>]*\bit=\"(?:v|e)\"[^>]*)>"
+    r"|<span[^>]*class=\"u\"[^>]*>(?P<unit>)",
+    re.S,
+)
+_TITLE_RE = re.compile(r"<span([^>]*id=\"o002\"[^>]*)>(.*?)</span>", re.S)
+_GFR_RE = re.compile(r"function\s+GFR\(\)[^\{]*\{[^\"]*\(\"(HMI\d+Read\.cgi)\"\)\s*;\s*\}")
+_LG_RE = re.compile(r"lg=\"([^\"]+)\"")
+_LG_SPAN_RE = re.compile(r"<span[^>]*lg=\"([^\"]+)\"[^>]*>.*?</span>", re.S)
+# Whole-page fallback: unit spans (id="uNNN" class="u") and value spans (id="oNNN", it="v"/"e")
+# in one scan; opening tags only, as in _BLOCK_RE, so a unit nested in a value span is still seen
+_FALLBACK_RE = re.compile(
+    r"<span[^>]*id=\"(?:u(?P<un>\d+)\"[^>]*class=\"u\"[^>]*>"
+    r"|(?P<vid>o\d+)\"(?P<vattr>[^>]*\bit=\"(?:v|e)\"[^>]*)>)",
+    re.S,
+)
+_ATTR_RE = re.compile(r"([a-zA-Z]+)=\"([^\"]*)\"")
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+# Entries repeat the same few short strings (it, units, enum options); share one object per value
+_INTERN: Dict[str, str] = {}
+_intern = _INTERN.setdefault
 
 
 def parse_page(client: HMIClient, languages: Dict[str, List[str]], page: str, lang_index: int = 0):
     html = client.fetch(page)
     # title
     title_text = ""
-    m_title = re.search(r"<span[^>]*id=\"o002\"[^>]*([^>]*)>(.*?)</span>", html, re.S)
+    m_title = _TITLE_RE.search(html)
     if m_title:
         attrs = m_title.group(1)
         inner = m_title.group(2)
-        m_lg = re.search(r"lg=\"([^\"]+)\"", attrs)
+        m_lg = _LG_RE.search(attrs)
         title_text = resolve_text_from_lg(languages, m_lg.group(1) if m_lg else None, lang_index)
 
     # Read endpoint from GFR() if present
-    m_gfr = re.search(r"function\s+GFR\(\)[^\{]*\{[^\"]*\(\"(HMI\d+Read\.cgi)\"\)\s*;\s*\}", html)
+    m_gfr = _GFR_RE.search(html)
     read_ep = m_gfr.group(1) if m_gfr else page.replace('.cgi', 'Read.cgi')
 
     entries = []
-    for m_div in DIV_RE.finditer(html):
+    # Cheap substring test first: firmware variants without d-divs skip the block scan entirely
+    has_divs = 'id="d' in html or "id='d" in html
+    for m_div in (DIV_RE.finditer(html) if has_divs else ()):
         n = m_div.group(1)
         block = m_div.group(2)
+        label_html = None
+        m_span = None
+        unit_html = None
+        for m in _BLOCK_RE.finditer(block):
+            if m.group('label') is not None:
+                if label_html is None:
+                    end = block.find('</td>', m.end())
+                    if end >= 0:
+                        label_html = block[m.end():end]
+            elif m.group('vid') is not None:
+                if m_span is None:
+                    m_span = m
+            elif unit_html is None:
+                end = block.find('</span>', m.end())
+                # A unit's text stays on the tag's line
+                if end >= 0 and '\n' not in block[m.end():end]:
+                    unit_html = block[m.end():end]
+            if label_html is not None and m_span is not None and unit_html is not None:
+                break
+        if not m_span:
+            continue
+
         # label
         label_text = ""
-        m_label = TD_LABEL_RE.search(block)
-        if m_label:
-            label_html = m_label.group(2)
-            m_lgspan = re.search(r"<span[^>]*lg=\"([^\"]+)\"[^>]*>.*?</span>", label_html, re.S)
+        if label_html is not None:
+            m_lgspan = _LG_SPAN_RE.search(label_html)
             if m_lgspan:
                 label_text = resolve_text_from_lg(languages, m_lgspan.group(1), lang_index)
             if not label_text:
                 # simple strip
-                label_text = re.sub(r"<[^>]+>", " ", label_html).strip()
-                label_text = re.sub(r"\s+", " ", label_text)
+                label_text = " ".join(_TAG_RE.sub(" ", label_html).split())
 
         # value span and attributes
-        # Find the first value span with an input type ('it') within the block
-        m_span = None
-        for m in SPAN_VAL_RE.finditer(block):
-            attrs_tmp = m.group(2)
-            if re.search(r"\bit=\"(v|e)\"", attrs_tmp):
-                m_span = m
-                break
-        if not m_span:
-            continue
-        span_id = m_span.group(1)
-        attrs = m_span.group(2)
-        inner = m_span.group(3)
+        span_id = m_span.group('vid')
+        # All attributes of the value span in one pass
+        attrs = dict(_ATTR_RE.findall(m_span.group('vattr')))
 
-        def get_attr(name: str) -> Optional[str]:
-            m = re.search(fr"{name}=\"([^\"]+)\"", attrs)
-            return m.group(1) if m else None
-
-        it = get_attr('it')  # e = enum, v = numeric value
-        mi = get_attr('mi')  # write identifier
-        enum_def = get_attr('e')
+        it = attrs.get('it')  # e = enum, v = numeric value
+        mi = attrs.get('mi') or None  # write identifier
+        enum_def = attrs.get('e') or None
         unit = None
         # unit span sits commonly as <span id="uXYZ" class="u">X</span> nearby in same block
-        m_unit = re.search(r"<span[^>]*class=\"u\"[^>]*>(.*?)</span>", block)
-        if m_unit:
-            unit = re.sub(r"<[^>]+>", " ", m_unit.group(1)).strip()
+        if unit_html is not None:
+            unit = _TAG_RE.sub(" ", unit_html).strip()
 
         enum_options: Optional[List[str]] = None
         if enum_def:
             # Enum def can be multiline with * separators
             enum_def = enum_def.replace("\r", " ").replace("\n", " ")
-            enum_options = [p.strip() for p in enum_def.split('*') if p.strip()]
+            enum_options = [_intern(p, p) for p in (q.strip() for q in enum_def.split('*')) if p]
         else:
             # Some enums are provided via language key on value span
-            lg_key = get_attr('lg')
+            lg_key = attrs.get('lg')
             if lg_key:
                 arr = languages.get(lg_key)
                 # languages[lg_key] is list of localized strings; take current language string and split by '*'
                 if isinstance(arr, list) and len(arr) > lang_index:
-                    enum_options = [p.strip() for p in str(arr[lang_index]).split('*') if p.strip()]
+                    enum_options = [_intern(p, p) for p in (q.strip() for q in str(arr[lang_index]).split('*')) if p]
 
+        if len(label_text) < 40:
+            label_text = sys.intern(label_text)
         entries.append({
-            'n': int(n), 'id': span_id, 'label': label_text, 'it': it, 'mi': mi,
-            'unit': unit, 'enum': enum_options,
+            'n': int(n), 'id': span_id, 'label': label_text, 'it': _intern(it, it) if it else None, 'mi': mi,
+            'unit': _intern(unit, unit) if unit is not None else None, 'enum': enum_options,
         })
 
     # Fallback: if no entries found by div-block parsing, scan the whole HTML for value spans
     if not entries:
+        # Single pass over the page collecting both unit spans and value spans
         units_map = {}
-        for mu in re.finditer(r"<span[^>]*id=\"u(\d+)\"[^>]*class=\"u\"[^>]*>(.*?)</span>", html, re.S):
-            units_map[mu.group(1)] = re.sub(r"<[^>]+>", " ", mu.group(2)).strip()
-        for m in SPAN_GLOBAL_RE.finditer(html):
-            span_id = m.group(1)  # e.g., o009
-            attrs = m.group(2)
-            # Only keep input/value spans having 'it="v"' or 'it="e"'
-            m_it = re.search(r"\bit=\"(v|e)\"", attrs)
-            if not m_it:
-                continue
-            it = m_it.group(1)
-            mi = None
-            m_mi = re.search(r"\bmi=\"([^\"]+)\"", attrs)
-            if m_mi:
-                mi = m_mi.group(1)
-            enum_def = None
-            m_e = re.search(r"\be=\"([^\"]+)\"", attrs)
-            if m_e:
-                enum_def = m_e.group(1)
+        spans = []
+        for m in _FALLBACK_RE.finditer(html):
+            if m.group('un') is not None:
+                end = html.find('</span>', m.end())
+                if end >= 0:
+                    units_map[m.group('un')] = _TAG_RE.sub(" ", html[m.end():end]).strip()
+            else:
+                spans.append(m)
+        for m in spans:
+            span_id = m.group('vid')  # e.g., o009
+            attrs = dict(_ATTR_RE.findall(m.group('vattr')))
+            it = attrs.get('it')
+            mi = attrs.get('mi') or None
+            enum_def = attrs.get('e') or None
             enum_options = None
             if enum_def:
                 enum_def = enum_def.replace("\r", " ").replace("\n", " ")
-                enum_options = [p.strip() for p in enum_def.split('*') if p.strip()]
+                enum_options = [_intern(p, p) for p in (q.strip() for q in enum_def.split('*')) if p]
             num = span_id[1:]
             unit = units_map.get(num)
-            entries.append({'n': -1, 'id': span_id, 'label': '', 'it': it, 'mi': mi, 'unit': unit, 'enum': enum_options})
+            entries.append({'n': -1, 'id': span_id, 'label': '', 'it': _intern(it, it) if it else None, 'mi': mi,
+                            'unit': _intern(unit, unit) if unit is not None else None, 'enum': enum_options})
 
     return {
         'page': page,
@@ -215,46 +291,49 @@ def parse_page(client: HMIClient, languages: Dict[str, List[str]], page: str, la
     }
 
 
+def _parse_record(rec: bytes, out: Dict[str, Tuple[str, str]]) -> None:
+    # rec is one 'id,type,\nvalue' record without the trailing '|'
+    while True:
+        head, sep, rest = rec.partition(b',')
+        if not sep:
+            return
+        words = head.split()
+        oid = words[-1] if words else b''
+        typ, sep2, val = rest.partition(b',')
+        if sep2 and oid[:1] == b'o' and oid[1:].isdigit() and len(typ) == 1 and typ.isalnum():
+            out[oid.decode('ascii')] = (typ.decode('ascii'), val.decode('utf-8', 'replace').strip())
+            return
+        # Not a record start: skip leading junk up to the next comma
+        rec = rest
+
+
 def read_values(client: HMIClient, read_endpoint: str) -> Dict[str, Tuple[str, str]]:
     """Return mapping id -> (type, value_str)."""
-    text = client.fetch(read_endpoint)
     out: Dict[str, Tuple[str, str]] = {}
     # Format: id,type,\nvalue|
     # We'll accept compact 'id,type,value|' too
-    i = 0
-    while i < len(text):
-        m = re.search(r"(o\d+),(\w),\s*\n?", text[i:])
-        if not m:
-            break
-        id_ = m.group(1)
-        typ = m.group(2)
-        i += m.end()
-        mval = re.search(r"(.*?)\|", text[i:], re.S)
-        if not mval:
-            break
-        val = mval.group(1).strip()
-        i += mval.end()
-        out[id_] = (typ, val)
+    # Split records on b'|' as chunks arrive; only the value bytes get decoded
+    buf = bytearray()
+    for chunk in client.fetch_stream(read_endpoint):
+        buf += chunk
+        start = 0
+        while True:
+            end = buf.find(b'|', start)
+            if end < 0:
+                break
+            _parse_record(bytes(buf[start:end]), out)
+            start = end + 1
+        del buf[:start]
     return out
 
 
-def read_ids(client: HMIClient, read_endpoint: str):
-    """Return a set of available object ids from a Read.cgi endpoint."""
-    text = client.fetch(read_endpoint)
-    ids = set()
-    for m in re.finditer(r"\b(o\d+),", text):
-        ids.add(m.group(1))
-    return ids
-
-
 def write_value(client: HMIClient, mi: str, value: str) -> bool:
     """Best-effort write via HMIinput.cgi.
     mi is the raw name like 'val:0x2302 0x4E25516C 0x100'.
     """
     try:
-        url = client.base + 'HMIinput.cgi'
         # Use params to get correct encoding
-        r = client.sess.get(url, params={mi: value}, timeout=10)
+        r = client.sess.get(client.input_url, params={mi: value}, timeout=10)
         r.raise_for_status()
         # No explicit result; assume success if 200
         return True
@@ -1,21 +1,37 @@
 import hashlib
 import json
 import re
+from functools import lru_cache
 from typing import Dict, List, Optional
 
+_SLUG_NONALNUM = re.compile(r"[^a-z0-9_]+")
+_SLUG_MULTI = re.compile(r"_+")
 
+
+@lru_cache(maxsize=256)
 def slugify(text: str) -> str:
     t = text.lower()
-    t = re.sub(r"[^a-z0-9_]+", "_", t)
-    t = re.sub(r"_+", "_", t).strip('_')
+    t = _SLUG_NONALNUM.sub("_", t)
+    t = _SLUG_MULTI.sub("_", t).strip('_')
     return t or "item"
 
 
+@lru_cache(maxsize=64)
+def _uid_prefix(host: str, page: str):
+    return hashlib.sha1(f"{host}|{page}|".encode())
+
+
+# SHA-1 is kept (not swapped for blake2b) so unique_ids of existing HA entities stay stable.
+@lru_cache(maxsize=4096)
 def unique_id(host: str, page: str, obj_id: str) -> str:
-    base = f"{host}|{page}|{obj_id}"
-    return hashlib.sha1(base.encode()).hexdigest()
+    # Same digest as sha1(f"{host}|{page}|{obj_id}"), reusing the hashed host|page| prefix
+    h = _uid_prefix(host, page).copy()
+    h.update(obj_id.encode())
+    return h.hexdigest()
 
 
+# Cached: every entity of a host shares the same dict, so callers must not mutate it.
+@lru_cache(maxsize=16)
 def device_payload(host: str, name: Optional[str] = None) -> Dict:
     name = name or f"Benekov @ {host}"
     return {
@@ -26,11 +42,16 @@ def device_payload(host: str, name: Optional[str] = None) -> Dict:
     }
 
 
+# State topics carry one JSON object per entity: {"v": <state>, <attributes>...}
+VALUE_TEMPLATE = "{{ value_json.v }}"
+
+
 def topics(base_topic: str, host: str, page: str, obj_id: str) -> Dict[str, str]:
     root = f"{base_topic}/{slugify(host)}/{page.replace('.cgi','')}/{obj_id}"
     return {
         "state": f"{root}/state",
         "command": f"{root}/set",
+        # No longer published (attributes ride on the state topic); discovery clears what <= 0.2.6 retained
         "attr": f"{root}/attributes",
     }
 
@@ -45,7 +66,8 @@ def sensor_config(discovery_prefix: str, base_topic: str, host: str, page: str,
         "name": name or obj_id,
         "unique_id": uid,
         "state_topic": t["state"],
-        "json_attributes_topic": t["attr"],
+        "value_template": VALUE_TEMPLATE,
+        "json_attributes_topic": t["state"],
         "device": device_payload(host),
         "icon": "mdi:thermometer",
     }
@@ -65,7 +87,8 @@ def number_config(discovery_prefix: str, base_topic: str, host: str, page: str,
         "unique_id": uid,
         "state_topic": t["state"],
         "command_topic": t["command"],
-        "json_attributes_topic": t["attr"],
+        "value_template": VALUE_TEMPLATE,
+        "json_attributes_topic": t["state"],
         "device": device_payload(host),
         "icon": "mdi:tune",
     }
@@ -92,7 +115,8 @@ def select_config(discovery_prefix: str, base_topic: str, host: str, page: str,
         "state_topic": t["state"],
         "command_topic": t["command"],
         "options": options,
-        "json_attributes_topic": t["attr"],
+        "value_template": VALUE_TEMPLATE,
+        "json_attributes_topic": t["state"],
         "device": device_payload(host),
         "icon": "mdi:menu",
     }
@@ -1,14 +1,21 @@
 import json
 import os
 import signal
+import socket
 import sys
 import threading
-import time
-from typing import Dict, List
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
 
 import paho.mqtt.client as mqtt
 
-from .api import HMIClient, build_languages, parse_page, read_values, read_ids, write_value
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+from .api import HMIClient, LazyLanguages, parse_page, read_values, write_value
 from .discovery import sensor_config, number_config, select_config, topics, slugify
 
 
@@ -17,10 +24,29 @@ def get_env(name: str, default: str = "") -> str:
     return default if v in (None, "", "null", "None") else v
 
 
+# Monitor profile: home page metrics published in this fixed order
+_MONITOR_HOME_DEFAULTS = (
+    ("o038", {"label": "Stav kotle", "it": "e", "enum_lg": "2. 512"}),
+    ("o044", {"label": "Aktuální výkon", "unit": "%", "it": "v"}),
+    ("o075", {"label": "B2 Teplota kotle", "unit": "°C", "it": "v"}),
+    ("o082", {"label": "B7 Teplota zpátečky", "unit": "°C", "it": "v"}),
+    ("o089", {"label": "B8 Teplota spalin", "unit": "°C", "it": "v"}),
+    ("o148", {"label": "Palivo", "it": "e"}),
+)
+
+
+def _dumps(obj) -> bytes:
+    # UTF-8 bytes either way, which paho publishes as-is
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
 def _load_options_json():
     try:
-        with open('/data/options.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open('/data/options.json', 'rb') as f:
+            data = f.read()
+        return orjson.loads(data) if orjson is not None else json.loads(data)
     except Exception:
         return None
 
@@ -88,37 +114,60 @@ class BenekovMQTT:
         if not self.base_url:
             print("HMI_BASE_URL not set", file=sys.stderr)
             sys.exit(2)
+        self.device_slug = slugify(self.base_url)
+        self.status_topic = f"{self.base_topic}/{self.device_slug}/status"
 
         self.client = HMIClient(self.base_url, self.username, self.password)
-        self.languages = build_languages(self.client)
+        # Downloaded on first lookup (page parsing), not before MQTT is up
+        self.languages = LazyLanguages(self.client)
         self.pages: Dict[str, Dict] = {}
         self.entities: Dict[str, Dict] = {}  # key -> entity def
+        self.by_read: Dict[str, List[Dict]] = {}  # read endpoint -> entities
+        self.command_to_ent: Dict[str, Dict] = {}  # command topic -> writable entity
+        self.pool = ThreadPoolExecutor(max_workers=4)
+        # Single worker: commands reach the HMI in the order they arrived
+        self.write_pool = ThreadPoolExecutor(max_workers=1)
+        self._missing_logged: Set[Tuple[str, str]] = set()  # (read endpoint, id) already reported missing
+        self.last_published: Dict[str, bytes] = {}  # topic -> last payload sent
+        self._primed: Dict[str, Dict[str, Tuple[str, str]]] = {}  # read endpoint -> values from build_pages
 
         self.mqtt = mqtt.Client()
         if self.mqtt_user:
             self.mqtt.username_pw_set(self.mqtt_user, self.mqtt_pass or None)
+        self.mqtt.on_connect = self.on_connect
+        self.mqtt.on_socket_open = self.on_socket_open
         self.mqtt.on_message = self.on_message
-        self.running = True
+        self._stop = threading.Event()
 
     def log(self, *args):
         print("[benekov]", *args, file=sys.stdout, flush=True)
 
     def connect_mqtt(self):
-        self.mqtt.will_set(f"{self.base_topic}/{slugify(self.base_url)}/status", payload="offline", retain=True)
+        self.mqtt.will_set(self.status_topic, payload="offline", retain=True)
         self.mqtt.connect(self.mqtt_host, self.mqtt_port, keepalive=30)
         self.mqtt.loop_start()
-        self.mqtt.publish(f"{self.base_topic}/{slugify(self.base_url)}/status", "online", retain=True)
+        self.mqtt.publish(self.status_topic, "online", retain=True)
+
+    def _load_page(self, page: str):
+        pg = parse_page(self.client, self.languages, page)
+        # Filter entries to only those that appear in Read.cgi or are explicit writable;
+        # the values read here also serve as the initial state
+        try:
+            vals = read_values(self.client, pg['read'])
+        except Exception:
+            vals = {}
+        return pg, vals
 
     def build_pages(self):
         pages = self.include_pages or ["HMI00001.cgi"]
-        for p in pages:
+        # Fetch and parse all pages concurrently; the filtering below stays in page order
+        futures = [(p, self.pool.submit(self._load_page, p)) for p in pages]
+        for p, fut in futures:
             try:
-                pg = parse_page(self.client, self.languages, p)
-                # Filter entries to only those that appear in Read.cgi or are explicit writable
-                try:
-                    idset = read_ids(self.client, pg['read'])
-                except Exception:
-                    idset = set()
+                pg, vals = fut.result()
+                idset = vals.keys()
+                if vals:
+                    self._primed[pg['read']] = vals
                 filtered = []
                 for ent in pg['entries']:
                     ok = (ent['id'] in idset or ent.get('it') in ('v', 'e'))
@@ -139,18 +188,10 @@ class BenekovMQTT:
                 pg['entries'] = filtered
                 # In monitor profile, build home metrics directly (fixed order)
                 if self.read_only and p == "HMI00001.cgi":
-                    wanted = [
-                        ("o038", {"label": "Stav kotle", "it": "e", "enum_lg": "2. 512"}),
-                        ("o044", {"label": "Aktuální výkon", "unit": "%", "it": "v"}),
-                        ("o075", {"label": "B2 Teplota kotle", "unit": "°C", "it": "v"}),
-                        ("o082", {"label": "B7 Teplota zpátečky", "unit": "°C", "it": "v"}),
-                        ("o089", {"label": "B8 Teplota spalin", "unit": "°C", "it": "v"}),
-                        ("o148", {"label": "Palivo", "it": "e"}),
-                    ]
                     # Keep enums/units from parsed entries when available
                     existing = {e['id']: e for e in pg['entries']}
                     forced = []
-                    for oid, meta in wanted:
+                    for oid, meta in _MONITOR_HOME_DEFAULTS:
                         ent = {
                             'page': p,
                             'id': oid,
@@ -205,122 +246,172 @@ class BenekovMQTT:
                 it = ent.get('it')
                 mi = ent.get('mi')
                 enum = ent.get('enum')
+                t = topics(self.base_topic, self.base_url, page, ent['id'])
 
                 # Keep a primary sensor for all entries
                 topic, payload = sensor_config(self.discovery_prefix, self.base_topic, self.base_url, page, ent['id'], label, unit)
-                self.mqtt.publish(topic, json.dumps(payload), retain=True)
+                self.mqtt.publish(topic, _dumps(payload), retain=True)
+                # Drop the retained attributes message left behind by the old two-topic layout
+                self.mqtt.publish(t["attr"], b"", retain=True)
 
                 # If writable numeric -> number entity
                 if (it == 'v' and mi) and not self.read_only:
                     # Optional limits not parsed here; could be enhanced
                     t2, p2 = number_config(self.discovery_prefix, self.base_topic, self.base_url, page, ent['id'], label, unit, None, None, None)
-                    self.mqtt.publish(t2, json.dumps(p2), retain=True)
+                    self.mqtt.publish(t2, _dumps(p2), retain=True)
                     # subscribe command
-                    self.mqtt.subscribe(topics(self.base_topic, self.base_url, page, ent['id'])["command"])
+                    self.mqtt.subscribe(t["command"])
 
                 # If enum -> select entity with options if present and writable
                 if (it == 'e' and enum and mi) and not self.read_only:
                     t3, p3 = select_config(self.discovery_prefix, self.base_topic, self.base_url, page, ent['id'], label, enum)
-                    self.mqtt.publish(t3, json.dumps(p3), retain=True)
-                    self.mqtt.subscribe(topics(self.base_topic, self.base_url, page, ent['id'])["command"])
+                    self.mqtt.publish(t3, _dumps(p3), retain=True)
+                    self.mqtt.subscribe(t["command"])
 
+                attrs_proto = {'page': page, 'label': label, 'unit': unit, 'type': it}
+                if enum:
+                    attrs_proto['options'] = enum
                 self.entities[ent_id] = {
                     'page': page, 'read': pg['read'], 'id': ent['id'], 'label': label, 'unit': unit,
-                    'it': it, 'mi': mi, 'enum': enum,
+                    'it': it, 'mi': mi, 'enum': enum, 'topics': t,
+                    'attrs_proto': attrs_proto,
+                    # Labels can repeat ('?'); like list.index, the first position wins
+                    'enum_index': {v: i for i, v in reversed(list(enumerate(enum)))} if enum else None,
                 }
 
+        # Group by read endpoint to minimize requests; entities are fixed after discovery
+        by_read: Dict[str, List[Dict]] = defaultdict(list)
+        for e in self.entities.values():
+            by_read[e['read']].append(e)
+        self.by_read = dict(by_read)
+        # Reverse index so a command message maps to its entity in O(1)
+        self.command_to_ent = {e['topics']['command']: e for e in self.entities.values() if e.get('mi')}
+
     def push_state(self):
-        # Read and publish
-        # Group by read endpoint to minimize requests
-        by_read: Dict[str, List[Dict]] = {}
-        for ent in self.entities.values():
-            by_read.setdefault(ent['read'], []).append(ent)
+        # Read and publish, one request per read endpoint
+        by_read = self.by_read
+        # Collect the cycle's messages first, then publish them in one burst
+        pending: List[Tuple[str, bytes]] = []
+        # Values read during build_pages are used once instead of fetching them again
+        primed, self._primed = self._primed, {}
+        # Read all endpoints concurrently; publishing stays on this thread
+        futures = {ep: self.pool.submit(read_values, self.client, ep) for ep in by_read if ep not in primed}
         for read_ep, ents in by_read.items():
             try:
-                vals = read_values(self.client, read_ep)
+                vals = primed.get(read_ep) or futures[read_ep].result(timeout=max(1, self.poll_interval - 1))
             except Exception as e:
                 self.log(f"read failed {read_ep}: {e}")
                 continue
-            for ent in ents:
-                typval = vals.get(ent['id'])
-                if not typval:
-                    # Keep trying next loop, but log once per cycle for visibility
+            self._collect_state(read_ep, ents, vals, pending)
+        self._publish_pending(pending)
+
+    def _refresh_endpoint(self, read_ep: str):
+        # Re-read a single endpoint after a write instead of polling everything
+        try:
+            vals = read_values(self.client, read_ep)
+        except Exception as e:
+            self.log(f"read failed {read_ep}: {e}")
+            return
+        ents = self.by_read.get(read_ep, [])
+        pending: List[Tuple[str, bytes]] = []
+        self._collect_state(read_ep, ents, vals, pending)
+        self._publish_pending(pending)
+
+    def _collect_state(self, read_ep: str, ents: List[Dict], vals: Dict[str, Tuple[str, str]],
+                       pending: List[Tuple[str, bytes]]):
+        for ent in ents:
+            typval = vals.get(ent['id'])
+            key = (read_ep, ent['id'])
+            if not typval:
+                # Keep trying next loop, but only log when the value first goes missing
+                if key not in self._missing_logged:
+                    self._missing_logged.add(key)
                     self.log(f"no value for {ent['id']} on {read_ep}")
-                    continue
-                typ, val = typval
-                # Map enums to text option if available
-                state_payload = val
-                if ent.get('it') == 'e' and ent.get('enum'):
-                    try:
-                        idx = int(val)
-                        opts = ent['enum']
-                        if 0 <= idx < len(opts):
-                            state_payload = opts[idx]
-                    except Exception:
-                        pass
-                # Publish state
-                t = topics(self.base_topic, self.base_url, ent['page'], ent['id'])
-                self.mqtt.publish(t['state'], state_payload, retain=True)
-                # Attributes
-                attrs = {
-                    'page': ent['page'],
-                    'label': ent['label'],
-                    'unit': ent['unit'],
-                    'type': ent['it'],
-                }
-                if ent.get('enum'):
-                    attrs['options'] = ent['enum']
-                    # Keep numeric index alongside, if numeric
-                    try:
-                        attrs['index'] = int(val)
-                    except Exception:
-                        pass
-                self.mqtt.publish(t['attr'], json.dumps(attrs), retain=True)
+                continue
+            self._missing_logged.discard(key)
+            typ, val = typval
+            # Map enums to text option if available
+            state_payload = val
+            if ent.get('it') == 'e' and ent.get('enum'):
+                try:
+                    idx = int(val)
+                    opts = ent['enum']
+                    if 0 <= idx < len(opts):
+                        state_payload = opts[idx]
+                except Exception:
+                    pass
+            # One retained JSON message carries both the state and its attributes
+            merged = {'v': state_payload, **ent['attrs_proto']}
+            if ent.get('enum'):
+                # Keep numeric index alongside, if numeric
+                try:
+                    merged['index'] = int(val)
+                except Exception:
+                    pass
+            pending.append((ent['topics']['state'], _dumps(merged)))
+
+    def _publish_pending(self, pending: List[Tuple[str, bytes]]):
+        for topic, payload in pending:
+            # State messages are retained, so an unchanged payload needs no republish
+            if self.last_published.get(topic) == payload:
+                continue
+            info = self.mqtt.publish(topic, payload, qos=0, retain=True)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self.last_published[topic] = payload
+
+    def on_socket_open(self, client, userdata, sock):
+        # Runs on every (re)connect: send each publish burst without Nagle delay, with room to queue it
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 262144)
+        except (AttributeError, OSError) as e:
+            self.log(f"socket tuning skipped: {e}")
+
+    def on_connect(self, client, userdata, flags, rc):
+        # A (re)connected broker may have lost retained messages; publish everything on the next poll
+        self.last_published.clear()
 
     def on_message(self, client, userdata, msg):
         # Command handler for number/select writes
         if self.read_only:
             # Ignore commands in monitor profile
             return
-        topic = msg.topic
+        ent = self.command_to_ent.get(msg.topic)
+        if not ent:
+            return
         payload = msg.payload.decode('utf-8').strip()
-        for key, ent in self.entities.items():
-            t = topics(self.base_topic, self.base_url, ent['page'], ent['id'])
-            if topic == t['command']:
-                mi = ent.get('mi')
-                if not mi:
-                    self.log(f"No write MI for {ent['id']}")
-                    return
-                write_ok = False
-                if ent['it'] == 'v':
-                    # Numeric value passthrough
-                    write_ok = write_value(self.client, mi, payload)
-                elif ent['it'] == 'e':
-                    # Map label to index if needed
-                    if ent.get('enum'):
-                        opts = ent['enum']
-                        try:
-                            # Accept either numeric index or label
-                            if payload.isdigit():
-                                idx = int(payload)
-                            else:
-                                idx = opts.index(payload)
-                            write_ok = write_value(self.client, mi, str(idx))
-                        except Exception:
-                            write_ok = False
-                    else:
-                        # If no enum list, try raw payload
-                        write_ok = write_value(self.client, mi, payload)
-                # Refresh state soon after write
-                if write_ok:
-                    self.log(f"Write OK {ent['id']} <- {payload}")
-                    time.sleep(0.5)
-                    self.push_state()
-                else:
-                    self.log(f"Write FAILED {ent['id']} <- {payload}")
-                break
+        # The HTTP write runs on the write worker so paho's network loop keeps dispatching
+        self.write_pool.submit(self._handle_command, ent, payload)
+
+    def _handle_command(self, ent: Dict, payload: str):
+        mi = ent['mi']
+        write_ok = False
+        if ent['it'] == 'v':
+            # Numeric value passthrough
+            write_ok = write_value(self.client, mi, payload)
+        elif ent['it'] == 'e':
+            # Map label to index if needed
+            if ent.get('enum'):
+                # Accept either numeric index or label
+                try:
+                    idx = int(payload)
+                except ValueError:
+                    idx = ent['enum_index'].get(payload)
+                if idx is not None and idx >= 0:
+                    write_ok = write_value(self.client, mi, str(idx))
+            else:
+                # If no enum list, try raw payload
+                write_ok = write_value(self.client, mi, payload)
+        # Refresh state soon after write
+        if write_ok:
+            self.log(f"Write OK {ent['id']} <- {payload}")
+            # Re-read just this endpoint shortly, without holding up queued writes
+            threading.Timer(0.2, self._refresh_endpoint, args=(ent['read'],)).start()
+        else:
+            self.log(f"Write FAILED {ent['id']} <- {payload}")
 
     def run(self):
+        self.log(f"json backend: {'orjson' if orjson is not None else 'stdlib json'}")
         self.connect_mqtt()
         self.build_pages()
         self.log(f"building pages for {len(self.include_pages)} pages: {', '.join(self.include_pages)}")
@@ -331,29 +422,31 @@ class BenekovMQTT:
         self.log("initial state published")
 
         def loop():
-            while self.running:
+            # The initial state was just published; the first poll is due one interval later
+            while not self._stop.wait(self.poll_interval):
                 try:
                     self.push_state()
                 except Exception as e:
                     self.log(f"poll error: {e}")
-                time.sleep(self.poll_interval)
 
         t = threading.Thread(target=loop, daemon=True)
         t.start()
 
         def handle_stop(signum, frame):
-            self.running = False
-            self.mqtt.publish(f"{self.base_topic}/{slugify(self.base_url)}/status", "offline", retain=True)
+            self._stop.set()
+            self.mqtt.publish(self.status_topic, "offline", retain=True)
             self.mqtt.loop_stop()
             self.mqtt.disconnect()
+            self.pool.shutdown(wait=False)
+            self.write_pool.shutdown(wait=False)
+            self.client.close()
             sys.exit(0)
 
         signal.signal(signal.SIGTERM, handle_stop)
         signal.signal(signal.SIGINT, handle_stop)
 
-        # Keep main thread alive
-        while self.running:
-            time.sleep(1)
+        # Keep main thread alive until a stop signal
+        self._stop.wait()
 
 
 if __name__ == "__main__":